@@ -73,10 +73,8 @@ def parse_args():
   )
 
   args = parser.parse_args()
-  files = []
-  for f in args.files:
-    files.extend(f.split(';'))
-  args.files = files
+  # Split CMake lists in one go, dropping empty entries
+  args.files = list(filter(None, ';'.join(args.files).split(';')))
 
   args.dump = True
   return args
@@ -1,69 +1,151 @@
-import json, os, sys, subprocess
+import hashlib, json, mmap, os, pickle, sys, subprocess, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from debase.cl_args import parse_args
 from pathlib import Path
-from hashlib import sha512
+from hashlib import sha256, sha512
 
 def errs(*args, **kwargs):
   print(*args, file=sys.stderr, **kwargs)
 
-def run_process(args, _cwd):
-  if type(args) is list:
-    args = ' '.join(args)
-  return subprocess.run(args, cwd=_cwd, capture_output=True, text=True)
+# stdout is never used, and stderr spills to a file that's only read back
+# on failure (or when asked), so nothing has to drain pipes.
+def run_process(args: list[str], _cwd, keep_stderr=False):
+  with tempfile.TemporaryFile() as err:
+    result = subprocess.run(args, cwd=_cwd, stdout=subprocess.DEVNULL, stderr=err)
+    result.stderr = ''
+    if keep_stderr or result.returncode != 0:
+      err.seek(0)
+      result.stderr = err.read().decode(errors='replace')
+  return result
+
+# Cheap stand-in for the file contents, only costs a stat()
+def file_fingerprint(path):
+  st = os.stat(path)
+  return f'{st.st_mtime_ns}:{st.st_size}:{st.st_ino}'
+
+def file_digest(path):
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      # Can't map an empty file
+      return sha512().hexdigest()
+    try:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return sha512(mm).hexdigest()
+    except (OSError, ValueError):
+      # Not mappable (pipes, odd filesystems), stream it instead
+      pass
+    if hasattr(hashlib, 'file_digest'):
+      return hashlib.file_digest(f, 'sha512').hexdigest()
+    # Python < 3.11
+    m = sha512()
+    while buf := f.read(1 << 20):
+      m.update(buf)
+    return m.hexdigest()
+
+# An entry from disk is only trusted if it's complete and the file didn't move
+def reusable_entry(old_entry, fingerprint):
+  return isinstance(old_entry, dict) and \
+    old_entry.get('stat') == fingerprint and \
+    isinstance(old_entry.get('sha512'), str)
+
+# Reuses old_entry if the file didn't move, else a new entry with no digest
+def check_entry(path, old_entry):
+  fingerprint = file_fingerprint(path)
+  if reusable_entry(old_entry, fingerprint):
+    return old_entry
+  return {'stat': fingerprint}
+
+def digest_entry(path, entry):
+  if 'sha512' not in entry:
+    entry['sha512'] = file_digest(path)
+  return entry
+
+# Only rehash the contents when the fingerprint moved
+def hash_entry(path, old_entry):
+  return digest_entry(path, check_entry(path, old_entry))
+
+def read_hashfile(hashfile):
+  try:
+    old_hash = json.loads(hashfile.read_text())
+  except (OSError, ValueError):
+    return None
+  return old_hash if isinstance(old_hash, dict) else None
+
+def same_hash(old_hash, new_hash):
+  if old_hash is None or old_hash.get('commands') != new_hash['commands']:
+    return False
+  old_files = old_hash.get('files')
+  if not isinstance(old_files, dict):
+    return False
+  for name, entry in new_hash['files'].items():
+    old_entry = old_files.get(name)
+    if not isinstance(old_entry, dict) or old_entry.get('sha512') != entry['sha512']:
+      return False
+  return True
 
 # We only want to skip processing if its *exactly* the same
 def calculate_and_write_hash(debase_bin, args):
-  o = Path(args.output)
-  target = o / Path(args.target)
-  json_result = o / 'lib' / args.jsonout
-  hashfile = o / (args.target + '.sha512')
-  # Binary hashes
-  a = sha512(Path(debase_bin).read_bytes()).hexdigest()
-  b = sha512(target.read_bytes()).hexdigest()
-  # JSON hashes
+  old_hash = read_hashfile(args.hashfile)
+  old_files = {}
+  if old_hash is not None and isinstance(old_hash.get('files'), dict):
+    old_files = old_hash['files']
+  # File fingerprints first, only the ones that moved need their contents
+  inputs = (
+    ('debase', debase_bin),
+    ('target', args.target_path),
+    ('json', args.json_result)
+  )
+  files = {name: check_entry(path, old_files.get(name)) for name, path in inputs}
+  stale = [(name, path) for name, path in inputs if 'sha512' not in files[name]]
+  if len(stale) == 1:
+    name, path = stale[0]
+    digest_entry(path, files[name])
+  elif stale:
+    # hashlib drops the GIL, so these can overlap
+    with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+      futures = [pool.submit(digest_entry, path, files[name]) for name, path in stale]
+      for future in futures:
+        future.result()
+  # CL stuff, fed in piecewise with separators so nothing gets joined
   m = sha512()
-  m.update(json_result.read_bytes())
-  # CL stuff
-  commands = ' '.join([
-    args.frame_pointer,
-    args.passthrough,
-    ''.join(args.files)
-  ])
-  m.update(commands.encode())
-  new_hash = a + b + m.hexdigest()
-  hashfile.write_text(new_hash)
+  m.update(args.frame_pointer.encode())
+  m.update(b'\x1f')
+  m.update(args.passthrough.encode())
+  m.update(b'\x1f')
+  for f in args.files:
+    m.update(f.encode())
+    m.update(b'\x1e')
+  new_hash = {'files': files, 'commands': m.hexdigest()}
+  args.hashfile.write_text(json.dumps(new_hash))
   return new_hash
 
 def check_hash_for_target(debase_bin, args):
-  o = Path(args.output)
-  json_result = o / 'lib' / args.jsonout
-  hashfile = o / (args.target + '.sha512')
-  if (not json_result.exists()) or (not hashfile.exists()):
+  if not args.json_result.exists():
     # There can't be a hash
     return False
-  # Read hash in
-  old_hash = hashfile.read_text()
+  # Read hash in, None if there isn't one
+  old_hash = read_hashfile(args.hashfile)
+  if old_hash is None:
+    return False
   # Calculate new hash
   new_hash = calculate_and_write_hash(debase_bin, args)
   # Check result
-  return old_hash == new_hash
+  return same_hash(old_hash, new_hash)
 
 def run_debaser(debase_bin, args):
-  o = Path(args.output)
-  target = Path(args.target)
   jsonout = '--output-filenames=' + args.jsonout
-  json_result = (o / 'lib' / args.jsonout)
-  passthrough = args.passthrough.split(';')
+  # Empty entries would reach the debaser as '' arguments
+  passthrough = list(filter(None, args.passthrough.split(';')))
   passthrough.extend(['--emit-all', '--allow-no-builtins', '--permissive'])
 
-  if not (o / target).exists():
-    errs('target', target.as_posix(), 'does not exist!')
+  if not args.target_path.exists():
+    errs('target', args.target_path.as_posix(), 'does not exist!')
     sys.exit(1)
   
   if check_hash_for_target(debase_bin, args):
-    return json_result
+    return args.json_result, True
 
-  (o / 'lib').mkdir(parents=True, exist_ok=True)
+  args.lib_dir.mkdir(parents=True, exist_ok=True)
 
   files = []
   for f in args.files:
@@ -71,8 +153,8 @@ def run_debaser(debase_bin, args):
 
   debase_args = [
     debase_bin,
-    (o / target).as_posix(),
-    '-o', (o / 'lib').as_posix(),
+    args.target_path.as_posix(),
+    '-o', args.lib_dir.as_posix(),
     jsonout,
     *passthrough,
     *files
@@ -80,17 +162,89 @@ def run_debaser(debase_bin, args):
 
   if args.dump:
     print(' '.join(debase_args))
-  result = run_process(debase_args, str(o))
+  result = run_process(debase_args, args.output_posix)
   if result.returncode != 0:
     errs(result.stderr.strip())
     errs('failed to run debaser!')
     sys.exit(result.returncode)
   
   calculate_and_write_hash(debase_bin, args)
-  return json_result
+  return args.json_result, False
+
+# Reuses the last parse of the debaser output when nothing changed
+def load_json_result(json_result, cached):
+  pickled = json_result.with_name(json_result.name + '.pickle')
+  if cached:
+    try:
+      if pickled.stat().st_mtime_ns >= json_result.stat().st_mtime_ns:
+        return pickle.loads(pickled.read_bytes())
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError,
+            AttributeError, ImportError, IndexError):
+      # Missing or corrupt, just reparse
+      pass
+  json_data = json.loads(json_result.read_text())
+  try:
+    pickled.write_bytes(pickle.dumps(json_data, pickle.HIGHEST_PROTOCOL))
+  except OSError:
+    # Only a cache, the build doesn't need it
+    pass
+  return json_data
+
+# One llc per bitcode file: llc only takes a single module, and merging them
+# with llvm-link first would collapse the per-file objects into one.
+def _llc_job(llc_bin, llc_O_flags, bc_file, o_str):
+  stem = os.path.splitext(os.path.basename(bc_file))[0]
+  out = f'{o_str}/{stem}.o'
+  llc_args = [
+    llc_bin,
+    *llc_O_flags,
+    '-filetype=obj',
+    '-o', out,
+    bc_file
+  ]
+  return out, llc_args
+
+# Rewrites the flags file only when llc or its flags change, its mtime marks
+# that. llc is keyed on its contents so an in-place upgrade counts.
+def _llc_flags_mtime(flagsfile, llc_bin, llc_O_flags):
+  old_flags = read_hashfile(flagsfile)
+  old_entry = None
+  if old_flags is not None and isinstance(old_flags.get('llc'), dict):
+    old_entry = old_flags['llc']
+  llc_entry = hash_entry(llc_bin, old_entry)
+  flags_hash = sha256(' '.join(llc_O_flags).encode()).hexdigest()
+  new_flags = {'llc': llc_entry, 'flags': flags_hash}
+  if old_flags is not None and old_entry is not None and \
+     old_flags.get('flags') == flags_hash and \
+     old_entry.get('sha512') == llc_entry['sha512']:
+    st = flagsfile.stat()
+    if llc_entry is not old_entry:
+      # Touched but identical, refresh the fingerprint and keep the mtime
+      flagsfile.write_text(json.dumps(new_flags))
+      os.utime(flagsfile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return st.st_mtime_ns
+  flagsfile.write_text(json.dumps(new_flags))
+  return flagsfile.stat().st_mtime_ns
+
+def _llc_up_to_date(out, bc_file, flags_mtime):
+  try:
+    out_mtime = os.stat(out).st_mtime_ns
+    bc_mtime = os.stat(bc_file).st_mtime_ns
+  except FileNotFoundError:
+    return False
+  # A tie can't be told apart on coarse timestamps, so it means rebuild
+  return out_mtime > bc_mtime and out_mtime > flags_mtime
+
+def _llc_one(out, llc_args, cwd, stop):
+  # Already doomed, don't bother spawning
+  if stop.is_set():
+    return out, None, None
+  #print(' '.join(llc_args))
+  result = run_process(llc_args, cwd)
+  return out, result.returncode, result.stderr
 
 def run_llc(llc_bin, args, bc_files: list[str]):
-  o = Path(args.output) / 'opt'
+  o = args.output / 'opt'
   o.mkdir(exist_ok=True)
 
   llc_O = {
@@ -100,40 +254,59 @@ def run_llc(llc_bin, args, bc_files: list[str]):
     'Release': ['-O=3', f'--frame-pointer={args.frame_pointer}', '--regalloc=pbqp'],
   }
 
-  out_files = []
-  failed = False
+  # Slots per bc file, so workers never share a list and link order is kept.
+  out_files = [None] * len(bc_files)
+  llc_errors = [None] * len(bc_files)
 
   failures = 0
   max_failures = min(len(bc_files) // 3, 5)
-  for bc_file in bc_files:
-    out = o / (Path(bc_file).stem + '.o')
-    llc_args = [
-      llc_bin,
-      *llc_O[args.build_type],
-      '-filetype=obj',
-      '-o', out.as_posix(),
-      bc_file
-    ]
-
-    #print(' '.join(llc_args))
-    result = run_process(llc_args, str(o))
-    if result.returncode == 0:
-      out_files.append(out.as_posix())
+  # Build every command up front so the workers only have to spawn.
+  llc_flags = llc_O[args.build_type]
+  o_str = o.as_posix()
+  # Per target, outputs can be shared by libraries building at the same time
+  flagsfile = o / (Path(args.target).name + '.flags')
+  flags_mtime = _llc_flags_mtime(flagsfile, llc_bin, llc_flags)
+  jobs = []
+  for i, bc_file in enumerate(bc_files):
+    out, llc_args = _llc_job(llc_bin, llc_flags, bc_file, o_str)
+    if _llc_up_to_date(out, bc_file, flags_mtime):
+      out_files[i] = out
     else:
-      errs('failed to run llc on', Path(bc_file).as_posix(), '!')
-      errs(result.stderr.strip())
-      failed = True
-      failures += 1
-    
-    if failures > max_failures:
-      break
+      jobs.append((i, out, llc_args))
+  cwd = str(o)
+  stop = threading.Event()
+  # LLC runs out of process, so threads are enough here.
+  workers = max(1, min(os.cpu_count() or 1, len(jobs)))
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = {
+      pool.submit(_llc_one, out, llc_args, cwd, stop): i
+      for i, out, llc_args in jobs
+    }
+    for future in as_completed(futures):
+      i = futures[future]
+      out, returncode, stderr = future.result()
+      if returncode == 0:
+        out_files[i] = out
+      elif returncode is not None:
+        llc_errors[i] = stderr
+        failures += 1
+
+      if failures > max_failures:
+        # Stop queued jobs, and any a worker picked up but hasn't spawned
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        break
   
-  if failed:
+  if failures != 0:
+    for bc_file, stderr in zip(bc_files, llc_errors):
+      if stderr is not None:
+        # The debaser already emits posix paths
+        errs('failed to run llc on', bc_file, '!')
+        errs(stderr.strip())
     sys.exit(1)
-  return out_files
+  return [out for out in out_files if out is not None]
 
 def run_archive(debase_bin, args, out_files):
-  o = Path(args.output)
   archive_only = '--archive-only'
   if len(args.archive) != 0:
     archive_only += f'={args.archive}'
@@ -142,13 +315,13 @@ def run_archive(debase_bin, args, out_files):
     debase_bin,
     archive_only,
     '--permissive',
-    '-o', o.as_posix(),
+    '-o', args.output_posix,
     *out_files,
     #'--verbose',
   ]
 
   print(' '.join(archive_args))
-  result = run_process(archive_args, str(o))
+  result = run_process(archive_args, args.output_posix, keep_stderr=True)
   errs(result.stderr.strip())
   if result.returncode != 0:
     errs('archiving failed!')
@@ -159,22 +332,31 @@ def run_archive(debase_bin, args, out_files):
 def generate_rsp(args, out_files):
   rsp = Path(args.response)
   if not rsp.is_absolute():
-    rsp = Path(args.output) / rsp
-  rsp.write_text(' '.join(out_files))
+    rsp = args.output / rsp
+  rsp.write_bytes(b' '.join(map(os.fsencode, out_files)))
   print(f'Generated response file \"@out/{rsp.name}\"!')
 
+# Built once here so the helpers don't keep reconstructing them
+def resolve_paths(args):
+  args.output = Path(args.output)
+  args.output_posix = args.output.as_posix()
+  args.target_path = args.output / args.target
+  args.lib_dir = args.output / 'lib'
+  args.json_result = args.lib_dir / args.jsonout
+  args.hashfile = args.output / (args.target + '.sha512')
+
 def debase_main(debase_bin, llc_bin):
   args = parse_args()
-  jsonout = run_debaser(debase_bin, args)
-  json_data = json.loads(jsonout.read_text())
+  resolve_paths(args)
+  jsonout, cached = run_debaser(debase_bin, args)
+  json_data = load_json_result(jsonout, cached)
 
   if json_data['files'] is None:
     errs('invalid debase json output: could not find "files": [...]')
     sys.exit(1)
   
   bc_files = json_data['files']
-  if type(bc_files) is str:
-    bc_files = [bc_files]
+  bc_files = [bc_files] if isinstance(bc_files, str) else bc_files
   
   out_files = run_llc(llc_bin, args, bc_files)
   if args.dump:
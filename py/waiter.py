@@ -1,4 +1,4 @@
-import argparse, os, sys, time
+import argparse, ctypes, os, select, sys, time
 
 def errs(*args, **kwargs):
   print(*args, file=sys.stderr, **kwargs)
@@ -17,14 +17,59 @@ def parse_args():
   )
   return parser.parse_args()
 
-def wait(fpath, timeout):
+# From <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE   = 0x00000100
+IN_NONBLOCK = 0o00004000
+IN_CLOEXEC  = 0o02000000
+
+# Returns None if inotify can't be used, the caller should poll instead.
+def wait_inotify(fpath, timeout):
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+  except (OSError, AttributeError):
+    return None
+  if fd < 0:
+    return None
+  try:
+    dirname = os.path.dirname(os.path.abspath(fpath))
+    if libc.inotify_add_watch(fd, os.fsencode(dirname), IN_CREATE | IN_MOVED_TO) < 0:
+      return None
+    deadline = time.monotonic() + timeout
+    # Checked after the watch is added so a creation can't slip between.
+    while not os.path.exists(fpath):
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return False
+      ready, _, _ = select.select([fd], [], [], remaining)
+      if ready:
+        try:
+          os.read(fd, 4096)
+        except BlockingIOError:
+          pass
+    return True
+  finally:
+    os.close(fd)
+
+def wait_poll(fpath, timeout):
   n = 0
   while not os.path.exists(fpath):
     time.sleep(1)
     n += 1
     if n > timeout:
-      errs('Timed out waiting for', fpath)
-      sys.exit(1)
+      return False
+  return True
+
+def wait(fpath, timeout):
+  found = None
+  if sys.platform.startswith('linux'):
+    found = wait_inotify(fpath, timeout)
+  if found is None:
+    found = wait_poll(fpath, timeout)
+  if not found:
+    errs('Timed out waiting for', fpath)
+    sys.exit(1)
 
 
 if __name__ == "__main__":